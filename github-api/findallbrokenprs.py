@@ -1,11 +1,13 @@
 #!/usr/bin/env python
-import os
-from github import Github
-from github.GithubException import UnknownObjectException
-import requests
+import asyncio
+import itertools
+import shelve
+import time
+import aiohttp
 import dotenv
-from tqdm import tqdm
+from tqdm.asyncio import tqdm_asyncio
 from tqdm.contrib.logging import logging_redirect_tqdm
+from typing import Sequence
 import argparse
 import os
 import logging
@@ -15,25 +17,342 @@ BROKEN_PRS_FILE = 'broken_prs.txt'
 PR_NOT_FOUND_FILE = 'pr_not_found.txt'
 PR_EXCEPTIONS_FILE = 'pr_exceptions.txt'
 LAST_ISSUE_FILE = 'last_issue.txt'
+# shelve keyed by '<owner>/<name>#<PR number>': {'commits': <commit count>}
+CACHE_FILE = 'gh_cache'
+GITHUB_URL = 'https://github.com'
+GITHUB_GRAPHQL_URL = 'https://api.github.com/graphql'
+DIFF_HEADERS = {'Accept': 'application/vnd.github.diff'}
+# GraphQL allows up to 100 aliased pullRequest nodes per query
+GRAPHQL_BATCH_SIZE = 100
+# below this many remaining requests a token is rested until its rate limit window resets
+RATE_LIMIT_THRESHOLD = 50
+MAX_RETRIES = 5
+MAX_BACKOFF = 16
+# how many PRs are checked at once and how many connections may be open to GitHub
+MAX_CONCURRENT_CHECKS = 32
+MAX_CONNECTIONS = 64
+# keep idle connections (and resolved addresses) around across rate limit pauses and slow batches
+KEEPALIVE_TIMEOUT = 60
+DNS_CACHE_TTL = 300
+# state files are flushed every FLUSH_EVERY writes instead of being reopened for each one
+WRITE_BUFFER_SIZE = 1 << 16
+FLUSH_EVERY = 100
+
+def write_to_file(handle, data: str, newline=True):
+    if newline:
+        handle.write(f'{data}\n')
+    else:
+        handle.write(data)
+
+
+def read_pr_numbers(file) -> set:
+    if not os.path.exists(file):
+        return set()
+    with open(file) as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+async def file_writer(queue: asyncio.Queue, issues: Sequence[int], state_dir: str, dry_run=False, track_last_issue=True):
+    # the only consumer of the queue, so appends to the state files never interleave.
+    # every state file is opened once and kept open, buffered, for the whole scan
+    handles = {}
+    written = 0
+    # PRs already recorded by this or a previous run are not appended again
+    recorded = {file: read_pr_numbers(os.path.join(state_dir, file)) for file in [BROKEN_PRS_FILE, PR_NOT_FOUND_FILE]}
+    # PRs finish out of order, last issue only moves past a PR once every PR before it is done
+    pending = iter(issues)
+    next_issue = next(pending, None)
+    done = set()
+    # latest resume point that is not on disk yet
+    last_issue = None
+
+    def flush():
+        nonlocal last_issue
+        # data files go first, so last issue never points past a PR whose record is still in a buffer
+        for file, handle in handles.items():
+            if file != LAST_ISSUE_FILE:
+                handle.flush()
+
+        if last_issue is not None:
+            if LAST_ISSUE_FILE not in handles:
+                handles[LAST_ISSUE_FILE] = open(os.path.join(state_dir, LAST_ISSUE_FILE), 'a')
+            # only the latest value matters, overwrite it in place
+            handles[LAST_ISSUE_FILE].seek(0)
+            handles[LAST_ISSUE_FILE].truncate()
+            write_to_file(handles[LAST_ISSUE_FILE], str(last_issue), newline=False)
+            handles[LAST_ISSUE_FILE].flush()
+            last_issue = None
+
+    try:
+        while True:
+            file, data = await queue.get()
+            try:
+                if file in recorded:
+                    if data in recorded[file]:
+                        continue
+                    recorded[file].add(data)
+
+                path = os.path.join(state_dir, file)
+                if file == LAST_ISSUE_FILE:
+                    # last issue is a resume point for range scans, --pr runs must not move it
+                    if not track_last_issue:
+                        continue
+
+                    done.add(int(data))
+                    advanced = None
+                    while next_issue is not None and next_issue in done:
+                        done.remove(next_issue)
+                        advanced = next_issue
+                        next_issue = next(pending, None)
+                    if advanced is None:
+                        continue
+
+                    if dry_run:
+                        logging.info(f'[Dry mode] Would write to {path}: {advanced}')
+                        continue
+                    # written out together with the data files on the next flush
+                    last_issue = advanced
+                else:
+                    if dry_run:
+                        logging.info(f'[Dry mode] Would write to {path}: {data}')
+                        continue
+
+                    if file not in handles:
+                        handles[file] = open(path, 'a', buffering=WRITE_BUFFER_SIZE)
+                    write_to_file(handles[file], data)
+
+                written += 1
+                if written % FLUSH_EVERY == 0:
+                    flush()
+            finally:
+                queue.task_done()
+    finally:
+        flush()
+        for handle in handles.values():
+            handle.close()
+
+
+class TokenPool:
+    def __init__(self, tokens):
+        self._tokens = tokens
+        self._cycle = itertools.cycle(tokens)
+        # Authorization headers are built once per token instead of on every request
+        self._auth_headers = {token: {'Authorization': f'Bearer {token}'} for token in tokens}
+        # last seen X-RateLimit-Remaining / X-RateLimit-Reset per token
+        self._remaining = {}
+        self._reset = {}
+
+    def next(self):
+        # round robin over the tokens, skipping the ones close to their limit until their window resets
+        now = time.time()
+        for _ in range(len(self._tokens)):
+            token = next(self._cycle)
+            if self._remaining.get(token, RATE_LIMIT_THRESHOLD) >= RATE_LIMIT_THRESHOLD or self._reset.get(token, 0) <= now:
+                return token
+        return None
+
+    def auth_headers(self, token: str) -> dict:
+        return self._auth_headers[token]
+
+    def wait_time(self) -> float:
+        return max(min(self._reset.values()) - time.time(), 0) + 1
+
+    def update(self, token: str, headers):
+        if 'X-RateLimit-Remaining' in headers and 'X-RateLimit-Reset' in headers:
+            self._remaining[token] = int(headers['X-RateLimit-Remaining'])
+            self._reset[token] = int(headers['X-RateLimit-Reset'])
+
+
+async def request_with_backoff(session: aiohttp.ClientSession, tokens: TokenPool, method: str, url: str, headers=None, read_body=True, **kwargs) -> aiohttp.ClientResponse:
+    logger = logging.getLogger(__name__)
 
-class SimpleIssue:
-    def __init__(self, number):
-        self._number = number
+    attempt = 0
+    while True:
+        token = tokens.next()
+        if token is None:
+            delay = tokens.wait_time()
+            logger.warning('All tokens are close to their rate limit, waiting %ss for a reset', int(delay))
+            await asyncio.sleep(delay)
+            continue
+
+        request_headers = {**headers, **tokens.auth_headers(token)} if headers else tokens.auth_headers(token)
+        async with session.request(method, url, headers=request_headers, **kwargs) as response:
+            # read the body so the response stays usable once the connection is released.
+            # status-only checks skip it, an unread body is dropped together with its connection
+            if read_body:
+                await response.read()
+        tokens.update(token, response.headers)
+
+        if attempt == MAX_RETRIES:
+            break
+        attempt += 1
+
+        if response.status in [403, 429] and 'Retry-After' in response.headers:
+            delay = int(response.headers['Retry-After'])
+            logger.warning('Rate limited on %s, retrying in %ss', url, delay)
+            await asyncio.sleep(delay)
+            continue
+
+        # this token is used up, the pool hands out another one (or waits) on the next attempt
+        if response.status in [403, 429] and response.headers.get('X-RateLimit-Remaining') == '0':
+            logger.warning('Token ran out of requests on %s, retrying', url)
+            continue
+
+        if response.status >= 500:
+            delay = min(2 ** (attempt - 1), MAX_BACKOFF)
+            logger.warning('Got %s from %s, retrying in %ss', response.status, url, delay)
+            await asyncio.sleep(delay)
+            continue
+
+        break
+
+    return response
+
+
+def build_batch_query(pr_numbers) -> str:
+    # one aliased pullRequest field per PR, so a single request covers the whole batch.
+    # the alias already carries the PR number, the commit count is the only field we need
+    prs = ' '.join(f'pr{pr_number}: pullRequest(number: {pr_number}) {{ commits {{ totalCount }} }}' for pr_number in pr_numbers)
+    return f'query($owner: String!, $name: String!) {{ repository(owner: $owner, name: $name) {{ {prs} }} }}'
+
+
+async def check_pr(session: aiohttp.ClientSession, sem: asyncio.Semaphore, queue: asyncio.Queue, cache, tokens: TokenPool, repo: str, pr_number: int, pr: dict):
+    logger = logging.getLogger(__name__)
 
-    @property
-    def number(self):
-        return self._number
+    try:
+        if pr['commits']['totalCount'] == 0:
+            logger.info('PR number: %s looks suspiciously empty', pr_number)
 
+            # only the status code matters, so don't download the (possibly huge) diff itself
+            diff_url = f'{GITHUB_URL}/{repo}/pull/{pr_number}.diff'
+            async with sem:
+                response = await request_with_backoff(session, tokens, 'HEAD', diff_url, headers=DIFF_HEADERS, read_body=False, allow_redirects=True)
+                if response.status == 405:
+                    response = await request_with_backoff(session, tokens, 'GET', diff_url, headers={**DIFF_HEADERS, 'Range': 'bytes=0-0'}, read_body=False)
+
+            # anything else (retries used up on 5xx, a 403 that isn't a rate limit, ...) tells us nothing
+            # about the diff, so the PR must end up in the exceptions file instead of being treated as fine
+            if response.status not in [200, 206, 404, 422]:
+                raise RuntimeError(f'Unexpected status {response.status} for {diff_url}')
+
+            if response.status in [404, 422]:
+                logger.info('PR number: %s has no diff. thats our guy', pr_number)
+
+                # append pr number to file
+                await queue.put((BROKEN_PRS_FILE, str(pr_number)))
+
+        # only touch the shelve when the entry actually changes
+        cached = {'commits': pr['commits']['totalCount']}
+        if cache.get(f'{repo}#{pr_number}') != cached:
+            cache[f'{repo}#{pr_number}'] = cached
+        await queue.put((LAST_ISSUE_FILE, str(pr_number)))
+
+    except Exception as e:
+        logger.exception('Exception occurred for PR number: %s', pr_number)
+
+        await queue.put((PR_EXCEPTIONS_FILE, str(pr_number)))
+        await queue.put((LAST_ISSUE_FILE, str(pr_number)))
+
+
+async def check_batch(session: aiohttp.ClientSession, sem: asyncio.Semaphore, queue: asyncio.Queue, cache, tokens: TokenPool, repo: str, pr_numbers: Sequence[int]):
+    logger = logging.getLogger(__name__)
+
+    # a PR that already had commits on a previous run can not turn into a broken one
+    checked = [pr_number for pr_number in pr_numbers if cache.get(f'{repo}#{pr_number}', {}).get('commits', 0) > 0]
+    for pr_number in checked:
+        logger.debug('PR number: %s has commits according to cache, skipping', pr_number)
+
+        await queue.put((LAST_ISSUE_FILE, str(pr_number)))
+
+    pr_numbers = [pr_number for pr_number in pr_numbers if pr_number not in checked]
+    if not pr_numbers:
+        return
+
+    owner, name = repo.split('/')
+    try:
+        async with sem:
+            logger.info('Checking PR numbers: %s', pr_numbers)
+
+            query = {
+                'query': build_batch_query(pr_numbers),
+                'variables': {'owner': owner, 'name': name},
+            }
+            response = await request_with_backoff(session, tokens, 'POST', GITHUB_GRAPHQL_URL, json=query)
+            response.raise_for_status()
+            result = await response.json()
+
+        if result.get('data') is None or result['data']['repository'] is None:
+            raise RuntimeError(f'GraphQL query failed: {result.get("errors")}')
+    except Exception as e:
+        logger.exception('Exception occurred for PR numbers: %s', pr_numbers)
+
+        for pr_number in pr_numbers:
+            await queue.put((PR_EXCEPTIONS_FILE, str(pr_number)))
+            await queue.put((LAST_ISSUE_FILE, str(pr_number)))
+        return
+
+    prs = result['data']['repository']
+    not_found = {error['path'][-1] for error in result.get('errors', []) if error.get('type') == 'NOT_FOUND'}
+
+    checks = []
+    for pr_number in pr_numbers:
+        alias = f'pr{pr_number}'
+        if prs.get(alias) is not None:
+            checks.append(check_pr(session, sem, queue, cache, tokens, repo, pr_number, prs[alias]))
+        elif alias in not_found:
+            logger.info('PR number: %s not found', pr_number)
+
+            await queue.put((PR_NOT_FOUND_FILE, str(pr_number)))
+            await queue.put((LAST_ISSUE_FILE, str(pr_number)))
+        else:
+            logger.error('PR number: %s missing from GraphQL response', pr_number)
+
+            await queue.put((PR_EXCEPTIONS_FILE, str(pr_number)))
+            await queue.put((LAST_ISSUE_FILE, str(pr_number)))
+
+    # only suspiciously empty PRs go on to the REST diff check
+    await asyncio.gather(*checks)
+
+
+async def scan_issues(issues: Sequence[int], tokens: TokenPool, repo: str, state_dir: str, dry_run=False, track_last_issue=True, use_cache=True):
+    queue = asyncio.Queue()
+    writer = asyncio.create_task(file_writer(queue, issues, state_dir, dry_run=dry_run, track_last_issue=track_last_issue))
+    sem = asyncio.Semaphore(MAX_CONCURRENT_CHECKS)
+
+    # slicing a range gives a range, so batches of a --start/--end scan stay lazy too
+    batches = [issues[i:i + GRAPHQL_BATCH_SIZE] for i in range(0, len(issues), GRAPHQL_BATCH_SIZE)]
+
+    # dry runs must not leave anything behind in the state dir, so they (and --no-cache runs) get a throwaway cache
+    persistent_cache = use_cache and not dry_run
+    cache = shelve.open(os.path.join(state_dir, CACHE_FILE)) if persistent_cache else {}
+
+    try:
+        # one pooled session for the whole scan so TCP/TLS setup is paid once per connection, not per request
+        connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, keepalive_timeout=KEEPALIVE_TIMEOUT, ttl_dns_cache=DNS_CACHE_TTL)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await tqdm_asyncio.gather(
+                *[check_batch(session, sem, queue, cache, tokens, repo, batch) for batch in batches],
+                unit='batch',
+                total=len(batches),
+            )
+    finally:
+        if persistent_cache:
+            cache.close()
+
+    # let the writer drain what is left before stopping it, stopping closes (and flushes) the state files.
+    # the writer only ever finishes on its own by failing, in that case nothing drains the queue anymore
+    drained = asyncio.ensure_future(queue.join())
+    await asyncio.wait([drained, writer], return_when=asyncio.FIRST_COMPLETED)
+    if writer.done():
+        drained.cancel()
+        # re-raise the writer's error instead of hanging
+        writer.result()
+    writer.cancel()
+    try:
+        await writer
+    except asyncio.CancelledError:
+        pass
 
-def write_to_file(file, data: str, mode='a', dry_run=False, newline=True):
-    if dry_run:
-        logging.info(f'[Dry mode] Would write to {file}: {data}')
-    else:
-        with open(file, mode) as f:
-            if newline:
-                f.write(f'{data}\n')
-            else:
-                f.write(data)
 
 def main():
     logging.basicConfig(level=logging.INFO)
@@ -44,10 +363,12 @@ def main():
     logger.info('Loading environment variables')
     dotenv.load_dotenv()
 
-    token = os.getenv('GITHUB_TOKEN')
+    # GITHUB_TOKENS takes a comma separated list, requests are spread over all of them
+    tokens = os.getenv('GITHUB_TOKENS') or os.getenv('GITHUB_TOKEN') or ''
+    tokens = [token.strip() for token in tokens.split(',') if token.strip()]
 
-    if token is None:
-        logger.error('Please set GITHUB_TOKEN environment variable')
+    if not tokens:
+        logger.error('Please set GITHUB_TOKENS or GITHUB_TOKEN environment variable')
         exit(1)
 
     argparser = argparse.ArgumentParser()
@@ -56,6 +377,7 @@ def main():
     argparser.add_argument('-p', '--pr', required=False, nargs='+', default=None, type=int, help='PR number to check')
     argparser.add_argument('--state-dir', required=False, default=os.path.join(os.getcwd(), 'data'), type=str, help='Directory to store state files')
     argparser.add_argument('--dry-run', required=False, default=False, action='store_true', help='Dry run mode')
+    argparser.add_argument('--no-cache', required=False, default=False, action='store_true', help='Ignore cached PR results from previous runs and do not update them')
     argparser.add_argument('--log-level', required=False, default='INFO', type=str, help='Log level')
     argparser.add_argument('--repo', required=False, default='miroapp-dev/server', type=str, help='Repository to check PRs for')
     argparser.description = r'''Find all broken PRs.
@@ -66,8 +388,6 @@ def main():
 
     args = argparser.parse_args()
 
-    g = Github(token)
-
     if args.pr is None and args.start is None and args.end is None:
         logger.error('Please provide either --pr, --start and --end arguments')
         exit(1)
@@ -76,17 +396,32 @@ def main():
         logger.error('Please provide either --pr or --start and --end arguments')
         exit(1)
 
-    logger.info('generating issues list')
+    # fail once here rather than in every GraphQL batch
+    owner, _, name = args.repo.partition('/')
+    if not owner or not name or '/' in name:
+        logger.error('Please provide --repo as <owner>/<name>')
+        exit(1)
 
+    # pick up where a previous range scan stopped
     last_issue_file = os.path.join(args.state_dir, LAST_ISSUE_FILE)
-    broken_prs_file = os.path.join(args.state_dir, BROKEN_PRS_FILE)
-    pr_not_found_file = os.path.join(args.state_dir, PR_NOT_FOUND_FILE)
-    pr_ex_file = os.path.join(args.state_dir, PR_EXCEPTIONS_FILE)
+    if args.start is not None and args.end is not None and os.path.exists(last_issue_file):
+        with open(last_issue_file) as f:
+            last_issue = f.read().strip()
+        # a last issue outside of the requested range belongs to some other scan, ignore it
+        if last_issue and args.start <= int(last_issue) < args.end:
+            resume = int(last_issue) + 1
+            if resume >= args.end:
+                logger.info('PRs %s to %s were already scanned (last issue: %s), nothing left to check', args.start, args.end - 1, last_issue)
+            else:
+                logger.info('Resuming from PR number: %s (last issue: %s)', resume, last_issue)
+            args.start = resume
+
+    logger.info('generating issues list')
 
     if args.pr is not None:
-        issues = [SimpleIssue(pr) for pr in args.pr]
+        issues = args.pr
     else:
-        issues = [SimpleIssue(num) for num in range(args.start, args.end)]
+        issues = range(args.start, args.end)
 
     if args.dry_run is False:
         os.makedirs(args.state_dir, exist_ok=True)
@@ -94,47 +429,10 @@ def main():
         logger.info('Dry run mode, not creating state files')
     # end_value = 30165 # got this number from github search using abot query
 
-    # Loop through each issue
+    # Check all issues concurrently
     logger.info('Scanning issues for broken PRs, total issues: %s', len(issues))
     with logging_redirect_tqdm(loggers=[logger, logging.root]):
-        for issue in tqdm(
-                issues,
-                unit='issue',
-                total=len(issues),
-            ):
-            try:
-                pr_number = issue.number
-                logger.info('Checking PR number: %s', pr_number)
-
-                # Request the diff for the PR
-                try:
-                    pr = g.get_repo("miroapp-dev/server").get_pull(pr_number)
-                except UnknownObjectException as e:
-                    logger.info('PR number: %s not found', pr_number)
-
-                    write_to_file(pr_not_found_file, str(pr_number), dry_run=args.dry_run)
-                    continue
-
-                if pr.commits == 0:
-                    logger.info('PR number: %s looks suspiciously empty', pr_number)
-
-                    headers = {
-                        'Authorization': f'Bearer {token}',
-                        'Accept': 'application/vnd.github.diff',
-                    }
-                    response = requests.get(pr.diff_url, headers=headers)
-                    if response.status_code in [404, 422]:
-                        logger.info('PR number: %s has no diff. thats our guy', pr_number)
-
-                        # append pr number to file
-                        write_to_file(broken_prs_file, pr_number, dry_run=args.dry_run)
-
-                write_to_file(last_issue_file, str(pr_number), dry_run=args.dry_run, newline=False, mode='w')
-
-            except Exception as e:
-                logger.exception('Exception occurred for PR number: %s', pr_number)
-
-                write_to_file(pr_ex_file, str(pr_number), dry_run=args.dry_run)
+        asyncio.run(scan_issues(issues, TokenPool(tokens), args.repo, args.state_dir, dry_run=args.dry_run, track_last_issue=args.pr is None, use_cache=not args.no_cache))
 
     logger.info('Done!')
 
@@ -151,6 +449,3 @@ if __name__ == '__main__':
 
 # # broken issue with no diff, normal issue with diff
 # issues = [Issue(18057), Issue(32559)]
-
-# Generate issues iterable object
-# if last_issue file exists open it and use it as start value
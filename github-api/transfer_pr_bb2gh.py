@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 import sys
 import os
-from typing import Union
+from typing import Optional, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import argparse
 import logging
@@ -10,6 +11,31 @@ from atlassian import Bitbucket
 from tqdm import tqdm
 import dotenv
 
+# caps how many PRs are processed against Bitbucket at once. this is a concurrency cap, not a rate limit:
+# with fast responses 10 workers (two calls per PR) can still go above 10 requests per second
+BB_MAX_WORKERS = 10
+
+
+# builds an updater function that implements CallableProgress type.
+# GitPython calls it for every progress line, so the bar is only moved in steps of 1% of max_count
+def progress_updater(pbar: tqdm):
+    last = [0]
+
+    def updater(op_code: int, cur_count: Union[str, float], max_count: Union[str, float, None], message: str) -> None:
+        cur_count = int(cur_count)
+        # every stage (counting, compressing, receiving, ...) counts from zero again
+        if cur_count < last[0]:
+            pbar.reset(total=int(max_count) if max_count else pbar.total)
+            last[0] = 0
+        elif max_count and int(max_count) != pbar.total:
+            pbar.total = int(max_count)
+
+        if cur_count - last[0] >= (pbar.total or 100) / 100:
+            pbar.update(cur_count - last[0])
+            last[0] = cur_count
+
+    return updater
+
 
 def main():
     logging.basicConfig(level=logging.INFO)
@@ -54,15 +80,20 @@ def main():
         logger.error('Please provide either --pr-ids or input data via stdin')
         exit(1)
 
-    if not sys.stdin.isatty():
+    # --pr-ids wins, stdin is only read when no IDs were given on the command line
+    if args.pr_ids is None:
         logger.info('Reading PR IDs from stdin')
-        # open stdin and read newline separated PR IDs
-        pr_ids = [int(pr_id) for pr_id in sys.stdin.read().split('\n') if pr_id]
-        #check if pr_ids only integers
-        if not all(isinstance(pr_id, int) for pr_id in pr_ids):
+        # read newline separated PR IDs line by line
+        try:
+            args.pr_ids = [int(line) for line in sys.stdin if line.strip()]
+        except ValueError:
             logger.error('Please provide only integers')
             exit(1)
 
+        if not args.pr_ids:
+            logger.error('Please provide either --pr-ids or input data via stdin')
+            exit(1)
+
     logger.info(f'Bitbucket repository URL: {args.bb_repo_url}')
 
     repo = None
@@ -70,22 +101,11 @@ def main():
     if not os.path.exists(args.repo_dir):
         logger.info(f'Cloning {args.bb_repo_url} to {args.repo_dir} (shallow clone)')
         # use tqdm to show progress bar
-        with tqdm(total=100) as pbar:
-            # defining updater function that implements CallableProgress type
-            def updater(op_code: int, cur_count: Union[str, float], max_count: Union[str, float, None], message: str) -> None:
-                pbar.update(int(cur_count))
-                pbar.total = int(max_count) if max_count else pbar.total
-
-            repo = Repo.clone_from(args.bb_repo_url, args.repo_dir, multi_options=['--bare', '--depth=1'], progress=updater, env=credentials_env)
+        with tqdm(total=100, mininterval=0.5) as pbar:
+            repo = Repo.clone_from(args.bb_repo_url, args.repo_dir, multi_options=['--bare', '--depth=1'], progress=progress_updater(pbar), env=credentials_env)
     else:
-        # if repo dir exist open it
+        # if repo dir exist open it, tags that are missing locally are fetched after tagging
         repo = Repo.init(args.repo_dir, bare=True)
-        with tqdm(total=100) as pbar:
-            logger.info(f'Fetching tags for {args.bb_repo_url}')
-            def updater(op_code: int, cur_count: Union[str, float], max_count: Union[str, float, None], message: str) -> None:
-                pbar.update(int(cur_count))
-                pbar.total = int(max_count) if max_count else pbar.total
-            repo.remotes.origin.fetch('+refs/tags/*:refs/tags/*', progress=updater, env=credentials_env)
 
     # check if origin github exists and set to args.gh_repo_url
     if 'github' not in [r.name for r in repo.remotes]:
@@ -110,57 +130,92 @@ def main():
         logger.exception(f'Bitbucket API error: {e}')
         exit(1)
 
-    logger.info('Scanning PRs for project: %s, repo: %s, total PRs: %s', args.bb_project, args.bb_repo_slug, len(args.pr_ids))
-    for pr in args.pr_ids:
-        logger.info(f'Processing PR: {pr}')
+    # tag a single PR, returns (tag_name, commit_hash, created) or None if the PR was skipped
+    def process_pr(pr_id: int) -> Optional[Tuple[str, str, bool]]:
+        logger.info(f'Processing PR: {pr_id}')
         try:
-            pr = bb.get_pull_request(args.bb_project, args.bb_repo_slug, pr)
+            pr = bb.get_pull_request(args.bb_project, args.bb_repo_slug, pr_id)
             logger.debug(f'PR: {pr}')
         except requests.exceptions.HTTPError as e:
             if e.response.status_code == 404:
-                logger.error(f'PR {pr} not found')
-                continue
+                logger.error(f'PR {pr_id} not found')
+            else:
+                logger.exception(f'Bitbucket API error: {e}')
+            return None
         except Exception as e:
             logger.exception(f'Bitbucket API error: {e}')
-            continue
+            return None
 
         if pr['fromRef']['latestCommit'] is None:
-            logger.error(f'PR {pr} has no commits')
-            continue
+            logger.error(f'PR {pr_id} has no commits')
+            return None
 
         commit_hash = pr['fromRef']['latestCommit']
         tag_name = f"dig-pr_{pr['id']}"
         logger.info(f'Tagging commit {commit_hash} with tag {tag_name}')
 
+        created = False
         if not args.dry_run:
             try:
                 bb.set_tag(args.bb_project, args.bb_repo_slug, tag_name, commit_hash)
+                created = True
             except requests.exceptions.HTTPError as e:
                 if e.response.status_code == 409:
                     logger.info(f'Tag {tag_name} already exists')
+                else:
+                    logger.exception(f'Bitbucket API error: {e}')
+                    return None
             except Exception as e:
                 logger.exception(f'Bitbucket API error: {e}')
-                continue
+                return None
 
-    logger.info('Done tagging PRs')
+        return tag_name, commit_hash, created
 
-    with tqdm(total=100) as pbar:
-        logger.info(f'Fetching tags for {args.bb_repo_url}')
-        def updater(op_code: int, cur_count: Union[str, float], max_count: Union[str, float, None], message: str) -> None:
-            pbar.update(int(cur_count))
-            pbar.total = int(max_count) if max_count else pbar.total
-        repo.remotes.origin.fetch('+refs/tags/*:refs/tags/*', progress=updater, env=credentials_env)
+    logger.info('Scanning PRs for project: %s, repo: %s, total PRs: %s', args.bb_project, args.bb_repo_slug, len(args.pr_ids))
+    # PRs are independent of each other, tag them in parallel with at most BB_MAX_WORKERS in flight
+    with ThreadPoolExecutor(max_workers=BB_MAX_WORKERS) as executor:
+        tagged = [result for result in executor.map(process_pr, args.pr_ids) if result is not None]
+
+    new_tags_created = sum(1 for _, _, created in tagged if created)
+    logger.info('Done tagging PRs, tagged: %s, new tags: %s', len(tagged), new_tags_created)
+
+    # only fetch the tags we are about to push and don't have yet, plus the ones just created on Bitbucket
+    # since a local tag with the same name may point to an old commit
+    local_tags = {tag.name for tag in repo.tags}
+    missing_tags = [tag_name for tag_name, _, created in tagged if created or tag_name not in local_tags]
+    if args.dry_run or not missing_tags:
+        logger.info('No tags to fetch from %s, skipping fetch', args.bb_repo_url)
+    else:
+        with tqdm(total=100, mininterval=0.5) as pbar:
+            logger.info(f'Fetching {len(missing_tags)} tags for {args.bb_repo_url}')
+            refspecs = [f'+refs/tags/{tag_name}:refs/tags/{tag_name}' for tag_name in missing_tags]
+            repo.remotes.origin.fetch(refspecs, progress=progress_updater(pbar), env=credentials_env)
+
+    # push all tags to github in a single atomic git push. the tagged commits are already on github,
+    # so there is no point in preparing a thin pack against them
+    refspecs = [f'refs/tags/{tag_name}:refs/tags/{tag_name}' for tag_name, _, _ in tagged]
+    logger.info(f'Pushing {len(refspecs)} tags to GitHub')
+    if not args.dry_run and refspecs:
+        try:
+            # --atomic is all or nothing: one rejected tag (e.g. it already exists on github at another commit)
+            # makes github reject every other tag of the batch with "atomic push failed"
+            retry = []
+            for info in repo.remotes.github.push(refspec=refspecs, atomic=True, no_thin=True):
+                if not info.flags & info.ERROR:
+                    continue
+                if 'atomic push failed' in info.summary:
+                    retry.append(f'{info.remote_ref_string}:{info.remote_ref_string}')
+                else:
+                    logger.error(f'Error pushing {info.remote_ref_string} to GitHub: {info.summary.strip()}')
+
+            if retry:
+                logger.warning(f'Atomic push rejected, pushing the remaining {len(retry)} tags without --atomic')
+                for info in repo.remotes.github.push(refspec=retry, no_thin=True):
+                    if info.flags & info.ERROR:
+                        logger.error(f'Error pushing {info.remote_ref_string} to GitHub: {info.summary.strip()}')
+        except Exception as e:
+            logger.exception(f'Error pushing tags to GitHub: {e}')
 
-    # push tags to github
-    for pr in args.pr_ids:
-        tag_name = f"dig-pr_{pr}"
-        logger.info(f'Pushing tag {tag_name} to GitHub')
-        if not args.dry_run:
-            try:
-                repo.remotes.github.push(f'refs/tags/{tag_name}:refs/tags/{tag_name}')
-            except Exception as e:
-                logger.exception(f'Error pushing tag {tag_name} to GitHub: {e}')
-                continue
 
 if __name__ == '__main__':
     main()
\ No newline at end of file